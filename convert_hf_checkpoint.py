@@ -44,7 +44,10 @@ def convert_hf_checkpoint(
     with EmptyInitOnDevice(device="meta", dtype=dtype):
         model = LLaMA(config)
 
-    qkv_size = model.transformer.h[0].attn.c_attn.weight.shape[0] // 3
+    # c_attn is laid out as [q (n_embd) | k (n_kv_head * head_size) | v (n_kv_head * head_size)]
+    head_size = config.n_embd // config.n_head
+    q_size = config.n_embd
+    kv_size = config.n_kv_head * head_size
 
     # initialize a new empty state dict to hold our new weights
     sd_meta = model.state_dict()
@@ -58,13 +61,13 @@ def convert_hf_checkpoint(
     if not bin_files:
         raise ValueError(f"Expected {str(checkpoint_dir)!r} to contain .bin files")
 
-    def permute(w):
+    def permute(w, n_head):
         dim = config.n_embd
         w = w._load_tensor().to(dtype)
         return (
-            w.view(config.n_head, 2, dim // config.n_head // 2, dim)
+            w.view(n_head, 2, head_size // 2, dim)
             .transpose(1, 2)
-            .reshape(dim, dim)
+            .reshape(n_head * head_size, dim)
         )
 
     weight_map = {
@@ -115,11 +118,11 @@ def convert_hf_checkpoint(
                             w = torch.empty(
                                 sd_meta[sd_key].shape, dtype=sd_meta[sd_key].dtype
                             )
-                            w[:qkv_size] = permute(unprocessed_weights[sd_key]["q_proj"])
-                            w[qkv_size:-qkv_size] = permute(
-                                unprocessed_weights[sd_key]["k_proj"]
+                            w[:q_size] = permute(unprocessed_weights[sd_key]["q_proj"], config.n_head)
+                            w[q_size : q_size + kv_size] = permute(
+                                unprocessed_weights[sd_key]["k_proj"], config.n_kv_head
                             )
-                            w[-qkv_size:] = (
+                            w[q_size + kv_size :] = (
                                 unprocessed_weights[sd_key]["v_proj"]
                                 ._load_tensor()
                                 .to(dtype)
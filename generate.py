@@ -75,6 +75,7 @@ def generate(
     temperature: float = 1.0,
     top_k: Optional[int] = None,
     eos_id: Optional[int] = None,
+    quantize_kv_cache: bool = False,
 ) -> torch.Tensor:
     """Takes a conditioning sequence (prompt) as input and continues to generate as many tokens as requested.
 
@@ -88,13 +89,15 @@ def generate(
         temperature: Scales the predicted logits by 1 / temperature
         top_k: If specified, only sample among the tokens with the k highest probabilities
         eos_id: If specified, stop generating any more token once the <eos> token is triggered
+        quantize_kv_cache: Whether to store the KV cache as int8 with per-token scales. Halves cache memory
+            but slows down decode, since the cache is dequantized in full at every step
     """
     # create an empty tensor of the expected final shape and fill in the current tokens
     T = prompt.size(0)
     T_new = T + max_new_tokens
     if max_seq_length is None:
         max_seq_length = min(T_new, model.config.block_size)
-    model.setup_caches(max_batch_size=1, max_seq_length=max_seq_length)
+    model.setup_caches(max_batch_size=1, max_seq_length=max_seq_length, quantize_kv_cache=quantize_kv_cache)
 
     device, dtype = prompt.device, prompt.dtype
     # create an empty tensor of the expected final shape and fill in the current tokens
@@ -141,6 +144,7 @@ def main(
     compile: bool = True,
     profile: Optional[Path] = None,
     max_optimize: bool = False,
+    quantize_kv_cache: bool = False,
 ) -> None:
     """Generates text samples based on a pre-trained LLaMA model and tokenizer.
 
@@ -156,6 +160,8 @@ def main(
         quantize: Whether to quantize the model and using which method:
             ``"llm.int8"``: LLM.int8() mode,
             ``"gptq.int4"``: GPTQ 4-bit mode.
+        quantize_kv_cache: Whether to store the KV cache as int8 with per-token scales. Halves cache memory
+            but slows down decode, since the cache is dequantized in full at every step.
     """
     assert checkpoint_path.is_file(), checkpoint_path
     assert tokenizer_path.is_file(), tokenizer_path
@@ -188,7 +194,9 @@ def main(
     model_size = sum([p.numel() * p.data.element_size() for p in itertools.chain(model.parameters(), model.buffers())])
     if compile:
         global decode_one_token, prefill
-        decode_one_token = torch.compile(decode_one_token, mode="reduce-overhead")
+        # decode shapes are fixed at (1, 1) and the KV cache is written in place, so capture a
+        # single static graph (CUDA graphs via reduce-overhead); prefill stays dynamic
+        decode_one_token = torch.compile(decode_one_token, mode="reduce-overhead", fullgraph=True, dynamic=False)
 
         # Apparently compiling only prefill but not decode gives bunk results???
         if max_optimize:
@@ -202,7 +210,7 @@ def main(
         import contextlib
         prof = contextlib.nullcontext() if i != num_samples - 1 or not profile else torch.profiler.profile()
         with prof:
-            y = generate(model, encoded, max_new_tokens, temperature=temperature, top_k=top_k)
+            y = generate(model, encoded, max_new_tokens, temperature=temperature, top_k=top_k, quantize_kv_cache=quantize_kv_cache)
         if hasattr(prof, "export_chrome_trace"):
             prof.export_chrome_trace(f"{profile}.json")
         torch.cuda.synchronize()
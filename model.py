@@ -14,6 +14,9 @@ from typing_extensions import Self
 
 
 
+# SDPA broadcasts grouped k/v heads itself on torch builds that document `enable_gqa` (2.5+)
+_SDPA_SUPPORTS_GQA = "enable_gqa" in (F.scaled_dot_product_attention.__doc__ or "")
+
 MaskCache = torch.Tensor
 RoPECache = torch.Tensor
 KVCache = Tuple[torch.Tensor, torch.Tensor]
@@ -55,10 +58,14 @@ class LLaMAConfig:
     n_layer: int = 32
     n_head: int = 32
     n_embd: int = 4096
+    # number of key/value heads for grouped-query attention, defaults to n_head (multi-head attention)
+    n_kv_head: Optional[int] = None
 
     def __post_init__(self):
         if self.padded_vocab_size is None:
             self.padded_vocab_size = find_multiple(self.vocab_size, 64)
+        if self.n_kv_head is None:
+            self.n_kv_head = self.n_head
 
     @classmethod
     def from_name(cls, name: str) -> Self:
@@ -72,36 +79,88 @@ llama_configs = {
     "65B": dict(n_layer=80, n_head=64, n_embd=8192),
 }
 
-class KVCache(nn.Module):
-    def __init__(self, max_batch_size, max_seq_length, n_heads, head_size, device='cuda', dtype=torch.bfloat16):
-        super().__init__()
-        cache_shape = (max_batch_size, n_heads, max_seq_length, head_size)
-        self.k_cache = torch.nn.Parameter(torch.zeros(cache_shape, device=device, dtype=dtype))
-        self.v_cache = torch.nn.Parameter(torch.zeros(cache_shape, device=device, dtype=dtype))
+class KVCache:
+    """One layer's K/V views into the storage owned by `KVCacheAggregator`."""
+    def __init__(self, k_cache, v_cache):
+        self.k_cache = k_cache
+        self.v_cache = v_cache
 
     def update(self, input_pos, k_val, v_val):
         # input_pos: [S], k_val: [B, H, S, D]
         assert input_pos.shape[0] == k_val.shape[2]
 
-        self.k_cache[:, :, input_pos] = k_val
-        self.v_cache[:, :, input_pos] = v_val
+        # index_copy_ writes in place without the generic index_put scatter, and unlike a
+        # python-int slice it keeps input_pos on device so the decode graph stays replayable
+        with torch.no_grad():
+            self.k_cache.index_copy_(2, input_pos, k_val)
+            self.v_cache.index_copy_(2, input_pos, v_val)
 
         return self.k_cache, self.v_cache
 
+class KVCacheInt8:
+    """KV cache stored as int8 with one absmax scale per (batch, head, position).
+
+    Halves cache memory relative to bf16, which allows longer contexts at a fixed VRAM budget. This is a
+    memory-only trade-off: every `update` dequantizes the whole cache into fresh activation-dtype tensors
+    for SDPA, so decode moves more bytes per step than the plain `KVCache` and is slower.
+    """
+    def __init__(self, k_cache, v_cache, k_scale, v_scale):
+        self.k_cache = k_cache
+        self.v_cache = v_cache
+        self.k_scale = k_scale
+        self.v_scale = v_scale
+
+    @staticmethod
+    def quantize(val):
+        # in float32 with a clamp: in bf16, val / scale can round to 127.5 -> 128, which wraps to -128
+        val = val.float()
+        scale = val.abs().amax(dim=-1, keepdim=True).clamp(min=1e-6) / 127
+        return torch.round(val / scale).clamp(-127, 127).to(torch.int8), scale
+
+    def update(self, input_pos, k_val, v_val):
+        # input_pos: [S], k_val: [B, H, S, D]
+        assert input_pos.shape[0] == k_val.shape[2]
+
+        with torch.no_grad():
+            k_q, k_scale = self.quantize(k_val)
+            v_q, v_scale = self.quantize(v_val)
+            self.k_cache.index_copy_(2, input_pos, k_q)
+            self.v_cache.index_copy_(2, input_pos, v_q)
+            self.k_scale.index_copy_(2, input_pos, k_scale.to(self.k_scale.dtype))
+            self.v_scale.index_copy_(2, input_pos, v_scale.to(self.v_scale.dtype))
+
+            k = self.k_cache.to(k_val.dtype) * self.k_scale.to(k_val.dtype)
+            v = self.v_cache.to(v_val.dtype) * self.v_scale.to(v_val.dtype)
+        return k, v
+
 class KVCacheAggregator(nn.Module):
+    """Owns the K/V storage of every layer as a single `(2, n_layer, B, H, S, D)` allocation.
+
+    The storage is the only registered buffer; per-layer caches are views handed out by `__getitem__`, so
+    `.to()` / `.cuda()` move one tensor and the layers never lose their link to it.
+    """
     def __init__(self):
         super().__init__()
-        self.kv_caches = nn.ModuleList([])
-
-    def initialize(self,layers, max_batch_size, max_seq_length, n_heads, head_size, device='cuda', dtype=torch.bfloat16):
-        cache_shape = (max_batch_size, n_heads, max_seq_length, head_size)
-        self.kv_caches = nn.ModuleList([KVCache(max_batch_size, max_seq_length, n_heads, head_size) for _ in range(layers)])
+        self.register_buffer("kv", None, persistent=False)
+        self.register_buffer("kv_scale", None, persistent=False)
+
+    def initialize(self,layers, max_batch_size, max_seq_length, n_heads, head_size, device='cuda', dtype=torch.bfloat16, quantize=False):
+        cache_shape = (2, layers, max_batch_size, n_heads, max_seq_length, head_size)
+        if quantize:
+            self.kv = torch.zeros(cache_shape, device=device, dtype=torch.int8)
+            self.kv_scale = torch.ones(cache_shape[:-1] + (1,), device=device, dtype=dtype)
+        else:
+            self.kv = torch.zeros(cache_shape, device=device, dtype=dtype)
+            self.kv_scale = None
 
     def __getitem__(self, idx):
-        return self.kv_caches[idx]
+        if self.kv_scale is not None:
+            return KVCacheInt8(self.kv[0, idx], self.kv[1, idx], self.kv_scale[0, idx], self.kv_scale[1, idx])
+        return KVCache(self.kv[0, idx], self.kv[1, idx])
 
     def clear(self):
-        self.kv_caches = nn.ParameterList([])
+        self.kv = None
+        self.kv_scale = None
 
 class LLaMA(nn.Module):
     def __init__(self, config: LLaMAConfig) -> None:
@@ -118,27 +177,28 @@ class LLaMA(nn.Module):
             )
         )
 
-        self.rope_cache: Optional[RoPECache] = None
-        self.mask_cache: Optional[MaskCache] = None
+        # a non-persistent buffer so it follows `.to()` / `.cuda()` but stays out of checkpoints; built in the
+        # weights' dtype (which init contexts like `EmptyInitOnDevice(dtype=...)` set) so apply_rope never casts it
+        self.register_buffer(
+            "rope_cache",
+            build_rope_cache(
+                seq_len=config.block_size,
+                n_elem=config.n_embd // config.n_head,
+                dtype=self.transformer.wte.weight.dtype,
+                device=None,
+            ),
+            persistent=False,
+        )
         self.kv_caches = KVCacheAggregator()
         self.max_batch_size = None
         self.max_seq_length = None
 
-    def setup_caches(self, max_batch_size, max_seq_length, device='cuda', dtype=torch.bfloat16):
+    def setup_caches(self, max_batch_size, max_seq_length, device='cuda', dtype=torch.bfloat16, quantize_kv_cache=False):
         head_size = self.config.n_embd // self.config.n_head
 
         self.max_seq_length = max_seq_length
         self.max_batch_size = max_batch_size
-        self.kv_caches.initialize(layers=self.config.n_layer, max_batch_size=max_batch_size, max_seq_length=max_seq_length, n_heads=self.config.n_head, head_size=head_size)
-
-        self.rope_cache = build_rope_cache(
-            seq_len=self.config.block_size,
-            n_elem=self.config.n_embd // self.config.n_head,
-            dtype=dtype,
-            device=device,
-        )
-        ones = torch.ones((self.config.block_size, self.config.block_size), device=device, dtype=torch.bool)
-        self.mask_cache = torch.tril(ones).unsqueeze(0).unsqueeze(0)
+        self.kv_caches.initialize(layers=self.config.n_layer, max_batch_size=max_batch_size, max_seq_length=max_seq_length, n_heads=self.config.n_kv_head, head_size=head_size, device=device, dtype=dtype, quantize=quantize_kv_cache)
 
     def _init_weights(self, module: nn.Module) -> None:
         if isinstance(module, nn.Linear):
@@ -161,8 +221,9 @@ class LLaMA(nn.Module):
         assert T <= block_size, f"Cannot forward sequence of length {T}, block size is only {block_size}"
 
         rope = self.rope_cache.index_select(0, input_pos)
-        mask = self.mask_cache.index_select(2, input_pos)
-        mask = mask[:, :, :, :max_seq_length]
+        # the query at position p sees cache slots [0, p]; slots past the current position are still
+        # zero-filled, so decode needs this too. (1, 1, T, max_seq_length), built without a block_size^2 buffer
+        mask = input_pos.view(1, 1, -1, 1) >= torch.arange(max_seq_length, device=input_pos.device)
 
         # forward the model itself
         x = self.transformer.wte(idx)  # token embeddings of shape (b, t, n_embd)
@@ -211,13 +272,16 @@ class CausalSelfAttention(nn.Module):
     def __init__(self, config: LLaMAConfig) -> None:
         super().__init__()
         assert config.n_embd % config.n_head == 0
+        assert config.n_head % config.n_kv_head == 0
 
         # key, query, value projections for all heads, but in a batch
-        self.c_attn = nn.Linear(config.n_embd, 3 * config.n_embd, bias=False)
+        head_size = config.n_embd // config.n_head
+        self.c_attn = nn.Linear(config.n_embd, config.n_embd + 2 * config.n_kv_head * head_size, bias=False)
         # output projection
         self.c_proj = nn.Linear(config.n_embd, config.n_embd, bias=False)
 
         self.n_head = config.n_head
+        self.n_kv_head = config.n_kv_head
         self.n_embd = config.n_embd
         self.block_size = config.block_size
 
@@ -233,23 +297,31 @@ class CausalSelfAttention(nn.Module):
         B, T, C = x.size()  # batch size, sequence length, embedding dimensionality (n_embd)
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
-        q, k, v = self.c_attn(x).split(self.n_embd, dim=2)
-
         head_size = C // self.n_head
-        k = k.view(B, T, self.n_head, head_size)
-        q = q.view(B, T, self.n_head, head_size)
-        v = v.view(B, T, self.n_head, head_size)
+        n_qk_head = self.n_head + self.n_kv_head
+        qkv = self.c_attn(x).view(B, T, n_qk_head + self.n_kv_head, head_size)
 
-        q = apply_rope(q, rope)
-        k = apply_rope(k, rope)
+        # q and k share the same rotation, so rotate them with a single call
+        qk = apply_rope(qkv[:, :, :n_qk_head], rope)
+        q, k = qk.split([self.n_head, self.n_kv_head], dim=2)
+        v = qkv[:, :, n_qk_head:]
 
-        k = k.transpose(1, 2)  # (B, nh, T, hs)
+        k = k.transpose(1, 2)  # (B, n_kv_head, T, hs)
         q = q.transpose(1, 2)  # (B, nh, T, hs)
-        v = v.transpose(1, 2)  # (B, nh, T, hs)
+        v = v.transpose(1, 2)  # (B, n_kv_head, T, hs)
 
         if kv_cache is not None:
             k, v = kv_cache.update(input_pos, k, v)
 
+        sdpa_kwargs = {}
+        if self.n_kv_head != self.n_head:
+            # grouped-query attention: each k/v head serves n_head // n_kv_head query heads
+            if _SDPA_SUPPORTS_GQA:
+                sdpa_kwargs["enable_gqa"] = True
+            else:
+                k = k.repeat_interleave(self.n_head // self.n_kv_head, dim=1)
+                v = v.repeat_interleave(self.n_head // self.n_kv_head, dim=1)
+
         # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
         #  att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
         #  att = att.masked_fill(mask[:,:,:T,:T] == 0, float('-inf'))
@@ -258,9 +330,11 @@ class CausalSelfAttention(nn.Module):
 
         # efficient attention using Flash Attention CUDA kernels
         # y = F.scaled_dot_product_attention(q, k, v)
-        y = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=0.0)
+        y = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=0.0, **sdpa_kwargs)
 
-        y = y.transpose(1, 2).contiguous().view(B, T, C)  # re-assemble all head outputs side by side
+        # re-assemble all head outputs side by side; the fused SDPA kernels (and any T == 1 decode step)
+        # already return memory laid out as (B, T, nh, hs), so this is a view rather than a copy
+        y = y.transpose(1, 2).reshape(B, T, C)
 
         # output projection
         y = self.c_proj(y)
@@ -303,8 +377,13 @@ class RMSNorm(nn.Module):
         # norm_x = x.norm(2, dim=self.dim, keepdim=True)
         # rms_x = norm_x * d_x ** (-1. / 2)
         # x_normed = x / (rms_x + self.eps)
-        norm_x = torch.mean(x * x, dim=self.dim, keepdim=True)
-        x_normed = x * torch.rsqrt(norm_x + self.eps)
+        if self.dim == -1 and hasattr(F, "rms_norm"):
+            # single fused kernel in eager, and a single reduction under torch.compile
+            return F.rms_norm(x, self.scale.shape, self.scale, self.eps)
+        # square and reduce in float32 (bf16 loses precision here), return in the input dtype
+        x_fp32 = x.float()
+        norm_x = torch.mean(x_fp32 * x_fp32, dim=self.dim, keepdim=True)
+        x_normed = (x_fp32 * torch.rsqrt(norm_x + self.eps)).type_as(x)
         return self.scale * x_normed
 
 
@@ -318,20 +397,18 @@ def build_rope_cache(
     https://github.com/labmlai/annotated_deep_learning_paper_implementations/blob/master/license.
     """
     # $\Theta = {\theta_i = 10000^{\frac{2(i-1)}{d}}, i \in [1, 2, ..., \frac{d}{2}]}$
-    theta = 1.0 / (base ** (torch.arange(0, n_elem, 2, dtype=dtype, device=device) / n_elem))
+    # angles are computed in float32: bf16 cannot represent positions past 256 exactly
+    theta = 1.0 / (base ** (torch.arange(0, n_elem, 2, dtype=torch.float32, device=device) / n_elem))
 
     # Create position indexes `[0, 1, ..., seq_len - 1]`
-    seq_idx = torch.arange(seq_len, dtype=dtype, device=device)
+    seq_idx = torch.arange(seq_len, dtype=torch.float32, device=device)
 
     # Calculate the product of position index and $\theta_i$
-    idx_theta = torch.outer(seq_idx, theta).float()
+    idx_theta = torch.outer(seq_idx, theta)
 
+    # interleaved (cos, sin) pairs, stored in the activation dtype so apply_rope never casts it
     cache = torch.stack([torch.cos(idx_theta), torch.sin(idx_theta)], dim=-1)
-
-    # this is to mimic the behaviour of complex32, else we will get different results
-    if dtype in (torch.float16, torch.bfloat16, torch.int8):
-        cache = cache.half()
-    return cache
+    return cache.to(dtype)
 
 
 def apply_rope(x: torch.Tensor, rope_cache: RoPECache) -> torch.Tensor:
@@ -339,16 +416,16 @@ def apply_rope(x: torch.Tensor, rope_cache: RoPECache) -> torch.Tensor:
     T = x.size(1)
     rope_cache = rope_cache[:T]
 
-    # cast because the reference does
-    xshaped = x.float().reshape(*x.shape[:-1], -1, 2)
-    rope_cache = rope_cache.view(1, xshaped.size(1), 1, xshaped.size(3), 2)
-    x_out2 = torch.stack(
-        [
-            xshaped[..., 0] * rope_cache[..., 0] - xshaped[..., 1] * rope_cache[..., 1],
-            xshaped[..., 1] * rope_cache[..., 0] + xshaped[..., 0] * rope_cache[..., 1],
-        ],
-        -1,
-    )
-
-    x_out2 = x_out2.flatten(3)
-    return x_out2.type_as(x)
+    # rotate in the activation dtype: (x0, x1) -> (x0 * cos - x1 * sin, x1 * cos + x0 * sin)
+    xshaped = x.reshape(*x.shape[:-1], -1, 2)
+    x0, x1 = xshaped.unbind(-1)
+    rope_cache = rope_cache.to(x.dtype).view(1, T, 1, xshaped.size(3), 2)
+    cos, sin = rope_cache.unbind(-1)
+
+    # write both lanes straight into a single output buffer instead of stacking temporaries
+    x_out2 = torch.empty_like(xshaped, memory_format=torch.contiguous_format)
+    out0, out1 = x_out2.unbind(-1)
+    out0.copy_(x0).mul_(cos).addcmul_(x1, sin, value=-1)
+    out1.copy_(x1).mul_(cos).addcmul_(x0, sin)
+
+    return x_out2.flatten(3)